@@ -1,215 +1,339 @@
 from astrbot.api.all import *
+from astrbot.api import logger
 import aiohttp
-import logging
-
-# 配置日志
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Callable, NamedTuple
+
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    import json
+    _json_loads = json.loads
 
 # 常量配置
 API_BASE_URL = "https://v2.xxapi.cn/api"
 USER_AGENT = "xiaoxiaoapi/1.0.0 (https://xxapi.cn)"
 COMMON_HEADERS = {"User-Agent": USER_AGENT}
 
+# 连接池默认配置，可在插件配置中覆盖
+DEFAULT_HTTP_CONFIG = {
+    "limit": 1000,
+    "limit_per_host": 100,
+    "ttl_dns_cache": 300,
+    "keepalive_timeout": 75,
+}
+
+# 响应缓存配置：各接口缓存时间（秒），未列出的接口不缓存
+CACHE_TTL = {
+    "whois": 3600,
+    "portscan": 60,
+}
+CACHE_MAX_SIZE = 256
+
+# 帮助信息
+HELP_TEXT = """
+站长工具使用帮助:
+
+/sitehelp    - 显示帮助信息
+/tcping <域名或IP地址> - TCP端口连通性测试
+/ping <网址> - 测试网站连通性
+/siteno <含http(s)的网址> - 测试网站延迟
+/whois <域名> - 查询域名信息
+/port <IP地址> - 端口扫描
+/site <含http(s)的网址>  - 获取网站截图
+
+示例:
+/tcping bing.com 或 /tcping bing.com 443
+/ping bing.com
+/siteno https://www.bing.com
+/whois bing.com
+/port 8.8.8.8
+/site https://www.bing.com"""
+
+# 参数缺失时的用法提示
+TCPING_USAGE = "传入需要tcping的ip或者域名，不需要加http或https!\n示例: /tcping bing.com\n示例: /tcping bing.com 443"
+TCPING_PORT_USAGE = "端口号必须是数字!\n示例: /tcping bing.com 443"
+PING_USAGE = "请输入要测试的域名!\n示例: /ping bing.com"
+SITENO_USAGE = "请输入要测试的网址，包含http(s)等！\n示例: /siteno https://www.bing.com"
+WHOIS_USAGE = "请输入要查询的域名!\n示例: /whois bing.com"
+PORT_USAGE = "请输入IP地址!\n示例: /port 8.8.8.8"
+SITE_USAGE = "请输入网址,包含http(s)等!\n示例: /site https://www.bing.com"
+
+
+def _format_port_scan(port_data: dict) -> str:
+    """格式化端口扫描结果"""
+    open_ports, closed_ports = [], []
+    for p, status in port_data.items():
+        (open_ports if status else closed_ports).append(p)
+        # 两类端口都已超过显示上限，无需继续遍历
+        if len(open_ports) > 20 and len(closed_ports) > 20:
+            break
+
+    # 限制最多显示20个端口
+    def truncate(ports):
+        return ports[:20] + ["..."] if len(ports) > 20 else ports
+
+    return f"""开放端口：{' | '.join(truncate(open_ports)) or '无'}
+未开放端口：{' | '.join(truncate(closed_ports)) or '无'}"""
+
+
+# 各接口成功响应的格式化函数
+def _fmt_tcping(event: AstrMessageEvent, data: dict) -> MessageEventResult:
+    return event.plain_result(
+        f"\n状态：{data['msg']}\n测试地址：{data['data']['address']}\n延迟：{data['data']['ping']}\n端口：{data['data']['port']}"
+    )
+
+
+def _fmt_ping(event: AstrMessageEvent, data: dict) -> MessageEventResult:
+    return event.plain_result(
+        f"\n状态：{data['msg']}\n延迟：{data['data']['time']}\nIP：{data['data']['server']}"
+    )
+
+
+def _fmt_speed(event: AstrMessageEvent, data: dict) -> MessageEventResult:
+    return event.plain_result(f"\n状态：{data['msg']}\n延迟：{data['data']}ms")
+
+
+def _fmt_whois(event: AstrMessageEvent, data: dict) -> MessageEventResult:
+    return event.plain_result(
+        f"""\n域名：{data['data']['Domain Name']}
+注册商：{data['data']['Sponsoring Registrar']}
+注册人：{data['data']['Registrant']}
+DNS：{', '.join(data['data']['DNS Serve'][:2])}
+有效期：{data['data']['Registration Time']} 至 {data['data']['Expiration Time']}"""
+    )
+
+
+def _fmt_portscan(event: AstrMessageEvent, data: dict) -> MessageEventResult:
+    return event.plain_result(_format_port_scan(data['data']))
+
+
+def _fmt_screenshot(event: AstrMessageEvent, data: dict) -> MessageEventResult:
+    # 优先使用已通过插件会话下载的图片，下载失败时交由框架按URL获取
+    image = data.get("image")
+    return event.chain_result([
+        Plain(f"截图成功：{data['msg']}\n"),
+        Image.fromBytes(image) if image else Image.fromURL(data['data'])
+    ])
+
+
+def _build_tcping(args: list) -> dict:
+    # 默认端口80，端口非数字时抛出ValueError
+    return {"address": args[0], "port": int(args[1]) if len(args) > 1 else 80}
+
+
+class Cmd(NamedTuple):
+    """命令定义：接口名、参数构造、结果格式化及用法提示"""
+    endpoint: str
+    build: Callable[[list], dict]
+    fmt: Callable[[AstrMessageEvent, dict], MessageEventResult]
+    usage: str
+    invalid_usage: str | None = None
+    download_image: bool = False
+
+
+COMMANDS = {
+    "tcping": Cmd("tcping", _build_tcping, _fmt_tcping, TCPING_USAGE, TCPING_PORT_USAGE),
+    "ping": Cmd("ping", lambda a: {"url": a[0]}, _fmt_ping, PING_USAGE),
+    "siteno": Cmd("speed", lambda a: {"url": a[0]}, _fmt_speed, SITENO_USAGE),
+    "whois": Cmd("whois", lambda a: {"domain": a[0]}, _fmt_whois, WHOIS_USAGE),
+    "port": Cmd("portscan", lambda a: {"address": a[0]}, _fmt_portscan, PORT_USAGE),
+    "site": Cmd("screenshot", lambda a: {"url": a[0]}, _fmt_screenshot, SITE_USAGE, download_image=True),
+}
+
 
 @register("astrbot_websitetool", "wxgl",
           "集成网站测试工具，支持连通性测试、速度测试、域名查询、端口扫描和截图。使用/sitehelp查看帮助", "1.0")
 class SiteToolsPlugin(Star):
-    def __init__(self, context: Context):
+    def __init__(self, context: Context, config: dict = None):
         super().__init__(context)
-        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(verify_ssl=False))
-
-    async def safe_fetch_json(self, url: str) -> dict:
-        """安全获取JSON数据"""
+        self.http_config = {**DEFAULT_HTTP_CONFIG, **(config or {})}
+        self._session: aiohttp.ClientSession | None = None
+        self._closed = False
+        self._cache: OrderedDict[tuple, tuple[float, dict]] = OrderedDict()
+        self._inflight: dict[tuple, asyncio.Task] = {}
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """获取HTTP会话，首次调用时在当前事件循环中创建"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                ssl=False,
+                limit=self.http_config["limit"],
+                limit_per_host=self.http_config["limit_per_host"],
+                ttl_dns_cache=self.http_config["ttl_dns_cache"],
+                keepalive_timeout=self.http_config["keepalive_timeout"],
+                enable_cleanup_closed=True
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                headers=COMMON_HEADERS,
+                timeout=aiohttp.ClientTimeout(total=15, connect=5, sock_read=10)
+            )
+        return self._session
+
+    async def terminate(self):
+        """插件卸载时关闭HTTP会话"""
+        # 卸载后不再创建新会话，避免连接泄漏
+        self._closed = True
+        if self._session and not self._session.closed:
+            await self._session.close()
+            # 等待底层SSL连接完成关闭
+            await asyncio.sleep(0)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.terminate()
+
+    async def _raw_fetch(self, url: str, params: dict | None = None) -> dict:
+        """发起请求并解析JSON，出错时返回错误信息"""
+        if self._closed:
+            return {"code": 500, "msg": "插件已卸载"}
         try:
-            async with self.session.get(url, headers=COMMON_HEADERS) as response:
+            session = await self._get_session()
+            async with session.get(url, params=params) as response:
                 response.raise_for_status()
-                return await response.json()
+                # 接口有时返回错误的Content-Type，跳过检查
+                return await response.json(loads=_json_loads, content_type=None)
+        except asyncio.TimeoutError:
+            logger.error("API请求超时: %s", url)
+            return {"code": 504, "msg": "上游超时"}
         except aiohttp.ClientError as e:
-            logger.error(f"API请求失败: {str(e)}")
+            logger.error("API请求失败: %s", e)
             return {"code": 500, "msg": "服务暂时不可用"}
         except Exception as e:
-            logger.error(f"未知错误: {str(e)}")
+            logger.error("未知错误: %s", e)
             return {"code": 500, "msg": "内部服务器错误"}
 
+    async def safe_fetch_json(self, url: str, params: dict | None = None, ttl: float = 0) -> dict:
+        """安全获取JSON数据，ttl大于0时缓存成功的响应，相同的并发请求只发起一次"""
+        key = (url, frozenset(params.items()) if params else None)
+        if ttl > 0:
+            cached = self._cache.get(key)
+            if cached and time.monotonic() - cached[0] < ttl:
+                self._cache.move_to_end(key)
+                return cached[1]
+
+        # 相同请求共用同一个任务，调用方被取消时只影响自身
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._raw_fetch(url, params))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        data = await asyncio.shield(task)
+
+        if ttl > 0 and data.get("code") == 200:
+            self._cache[key] = (time.monotonic(), data)
+            self._cache.move_to_end(key)
+            if len(self._cache) > CACHE_MAX_SIZE:
+                self._cache.popitem(last=False)
+        return data
+
+    async def fetch_bytes(self, url: str) -> bytes | None:
+        """通过插件会话下载二进制内容，失败时返回None"""
+        if self._closed:
+            return None
+        try:
+            session = await self._get_session()
+            async with session.get(url) as response:
+                response.raise_for_status()
+                return await response.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error("下载失败: %s", e)
+            return None
+        except Exception as e:
+            logger.error("下载时发生未知错误: %s", e)
+            return None
+
     def parse_command_args(self, event: AstrMessageEvent, min_args: int = 1) -> list:
         """解析命令参数"""
-        # 提取所有文本消息内容
-        text_parts = [
-            component.text.strip()
-            for component in event.get_messages()
-            if isinstance(component, Plain)  # 只处理Plain类型数据
-        ]
-
-        if not text_parts:
+        # 只处理第一条Plain类型消息
+        for component in event.get_messages():
+            if isinstance(component, Plain):
+                text = component.text
+                break
+        else:
             return []
 
-        full_text = "".join(text_parts)
-        parts = full_text.split(maxsplit=1)
-
-        if len(parts) < min_args + 1:
+        # 去掉命令本身，剩余部分即为参数（命令与参数间可以是任意空白字符）
+        parts = text.split(None, 1)
+        # 不带参数时直接返回
+        if len(parts) < 2:
             return []
 
-        return parts[1].split()  # 返回参数列表
+        args = parts[1].split()
+
+        return args if len(args) >= min_args else []
 
     async def send_api_result(
             self,
             event: AstrMessageEvent,
             endpoint: str,
             params: dict,
-            success_handler: callable
+            success_handler: callable,
+            download_image: bool = False
     ) -> MessageEventResult:
-        """统一处理API请求和响应"""
+        """统一处理API请求和响应，download_image为True时通过插件会话下载data中的图片"""
         url = f"{API_BASE_URL}/{endpoint}"
-        url += "?" + "&".join([f"{k}={v}" for k, v in params.items()])
-        logger.info(f"请求API: {url}")
+        logger.info("请求API: %s %s", url, params)
 
-        data = await self.safe_fetch_json(url)
+        data = await self.safe_fetch_json(url, params, ttl=CACHE_TTL.get(endpoint, 0))
         if data.get("code") == 200:
-            return success_handler(data)
+            if download_image:
+                data = {**data, "image": await self.fetch_bytes(data["data"])}
+            return success_handler(event, data)
         else:
             return event.plain_result(f"\n错误：{data.get('msg', '未知错误')}")
 
     @command("sitehelp")
     async def show_help(self, event: AstrMessageEvent) -> MessageEventResult:
         """显示帮助信息"""
-        help_text = """
-站长工具使用帮助:
-
-/sitehelp    - 显示帮助信息
-/tcping <域名或IP地址> - TCP端口连通性测试
-/ping <网址> - 测试网站连通性
-/siteno <含http(s)的网址> - 测试网站延迟
-/whois <域名> - 查询域名信息
-/port <IP地址> - 端口扫描
-/site <含http(s)的网址>  - 获取网站截图
-
-示例:
-/tcping bing.com 或 /tcping bing.com 443
-/ping bing.com
-/siteno https://www.bing.com
-/whois bing.com
-/port 8.8.8.8
-/site https://www.bing.com"""
-        return event.plain_result(help_text)
+        return event.plain_result(HELP_TEXT)
 
-    @command("tcping")
-    async def check_tcping(self, event: AstrMessageEvent) -> MessageEventResult:
-        """TCP端口连通性测试"""
+    async def _dispatch(self, event: AstrMessageEvent, name: str) -> MessageEventResult:
+        """按命令表解析参数并请求对应接口"""
+        cmd = COMMANDS[name]
         args = self.parse_command_args(event)
         if not args:
-            return event.plain_result("传入需要tcping的ip或者域名，不需要加http或https!\n示例: /tcping bing.com\n示例: /tcping bing.com 443")
-
-        host = args[0]
-        port = args[1] if len(args) > 1 else "80"  # 默认端口80
+            return event.plain_result(cmd.usage)
 
         try:
-            port = int(port)
+            params = cmd.build(args)
         except ValueError:
-            return event.plain_result("端口号必须是数字!\n示例: /tcping bing.com 443")
-
-        return await self.send_api_result(
-            event,
-            endpoint="tcping",
-            params={"address": host, "port": port},
-            success_handler=lambda data: event.plain_result(
-                f"\n状态：{data['msg']}\n测试地址：{data['data']['address']}\n延迟：{data['data']['ping']}\n端口：{data['data']['port']}"
-            )
-        )
+            return event.plain_result(cmd.invalid_usage or cmd.usage)
+
+        return await self.send_api_result(event, cmd.endpoint, params, cmd.fmt, cmd.download_image)
+
+    @command("tcping")
+    async def check_tcping(self, event: AstrMessageEvent) -> MessageEventResult:
+        """TCP端口连通性测试"""
+        return await self._dispatch(event, "tcping")
 
     @command("ping")
     async def check_ping(self, event: AstrMessageEvent) -> MessageEventResult:
         """检测网站连通性"""
-        args = self.parse_command_args(event)
-        if not args:
-            return event.plain_result("请输入要测试的域名!\n示例: /ping bing.com")
-
-        return await self.send_api_result(
-            event,
-            endpoint="ping",
-            params={"url": args[0]},
-            success_handler=lambda data: event.plain_result(
-                f"\n状态：{data['msg']}\n延迟：{data['data']['time']}\nIP：{data['data']['server']}"
-            )
-        )
+        return await self._dispatch(event, "ping")
 
     @command("siteno")
     async def check_latency(self, event: AstrMessageEvent) -> MessageEventResult:
         """检测网站延迟"""
-        args = self.parse_command_args(event)
-        if not args:
-            return event.plain_result("请输入要测试的网址，包含http(s)等！\n示例: /siteno https://www.bing.com")
-
-        return await self.send_api_result(
-            event,
-            endpoint="speed",
-            params={"url": args[0]},
-            success_handler=lambda data: event.plain_result(
-                f"\n状态：{data['msg']}\n延迟：{data['data']}ms"
-            )
-        )
+        return await self._dispatch(event, "siteno")
 
     @command("whois")
     async def query_whois(self, event: AstrMessageEvent) -> MessageEventResult:
         """WHOIS查询"""
-        args = self.parse_command_args(event)
-        if not args:
-            return event.plain_result("请输入要查询的域名!\n示例: /whois bing.com")
-
-        return await self.send_api_result(
-            event,
-            endpoint="whois",
-            params={"domain": args[0]},
-            success_handler=lambda data: event.plain_result(
-                f"""\n域名：{data['data']['Domain Name']}
-注册商：{data['data']['Sponsoring Registrar']}
-注册人：{data['data']['Registrant']}
-DNS：{', '.join(data['data']['DNS Serve'][:2])}
-有效期：{data['data']['Registration Time']} 至 {data['data']['Expiration Time']}"""
-            )
-        )
+        return await self._dispatch(event, "whois")
 
     @command("port")
     async def scan_ports(self, event: AstrMessageEvent) -> MessageEventResult:
         """端口扫描"""
-        args = self.parse_command_args(event)
-        if not args:
-            return event.plain_result("请输入IP地址!\n示例: /port 8.8.8.8")
-
-        return await self.send_api_result(
-            event,
-            endpoint="portscan",
-            params={"address": args[0]},
-            success_handler=lambda data: event.plain_result(
-                self._format_port_scan(data['data'])
-            )
-        )
-
-    def _format_port_scan(self, port_data: dict) -> str:
-        """格式化端口扫描结果"""
-        open_ports = [p for p, status in port_data.items() if status]
-        closed_ports = [p for p, status in port_data.items() if not status]
-
-        # 限制最多显示20个端口
-        def truncate(ports):
-            return ports[:20] + ["..."] if len(ports) > 20 else ports
-
-        return f"""开放端口：{' | '.join(truncate(open_ports)) or '无'}
-未开放端口：{' | '.join(truncate(closed_ports)) or '无'}"""
+        return await self._dispatch(event, "port")
 
     @command("site")
     async def capture_site(self, event: AstrMessageEvent) -> MessageEventResult:
         """网站截图"""
-        args = self.parse_command_args(event)
-        if not args:
-            return event.plain_result("请输入网址,包含http(s)等!\n示例: /site https://www.bing.com")
-
-        return await self.send_api_result(
-            event,
-            endpoint="screenshot",
-            params={"url": args[0]},
-            success_handler=lambda data: event.chain_result([
-                Plain(f"截图成功：{data['msg']}\n"),
-                Image.fromURL(data['data'])
-            ])
-        )
+        return await self._dispatch(event, "site")